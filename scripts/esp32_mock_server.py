@@ -1,23 +1,113 @@
 import argparse
 import asyncio
-import json
 import logging
+import os
 import time
 import sys
 import socket
+import orjson
 from aiohttp import web
 
+try:
+    # Optional: libuv-based event loop, not available on Windows
+    import uvloop
+except ImportError:
+    uvloop = None
+
 logging.basicConfig(level=logging.WARNING) # Reduce log level
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO) # Keep our logs visible
 
-# Global variable for current message
-current_message = None
-current_message_id = None
+# Pre-encoded empty /messages body
+_EMPTY_BODY = b'{}'
+
+# Long-poll: GET /messages waits on app['msg_slot'].ready instead of returning {}
+# straight away. Keep the wait under the app's 2s poll timeout
+# (see HttpService._pollEsp32).
+LONG_POLL_TIMEOUT = 1.5
+
+DISCOVER_BYTES = b"FLUENS_DISCOVER"
+DISCOVER_LEN = len(DISCOVER_BYTES)
 
-async def udp_discovery_loop(http_port):
+def _reply_for(http_port):
+    """Discovery reply carrying our HTTP port; the port never changes, so encode once"""
+    return f"FLUENS_ESP32_HERE:{http_port}".encode('utf-8')
+
+def _handle_discovery(view, n, addr, reply, send):
+    """
+    Answers one packet held in view[:n] if it is a discovery request.
+    Shared by DiscoveryReceiver and DiscoveryProtocol.
     """
-    Listens for UDP broadcast discovery packets and responds logic.
+    # Fast path: exact token, compared in place without copying.
+    # Anything longer may still be the token padded with whitespace.
+    if n == DISCOVER_LEN:
+        matched = view[:n] == DISCOVER_BYTES
+    else:
+        matched = n > DISCOVER_LEN and bytes(view[:n]).strip() == DISCOVER_BYTES
+    if not matched:
+        return
+
+    try:
+        # Respond with our HTTP port
+        send(reply, addr)
+        logger.info(f"Received discovery from {addr}, responded with {reply.decode('utf-8')}")
+    except Exception as e:
+        logger.error(f"UDP Error: {e}")
+
+class DiscoveryReceiver:
+    """
+    Answers UDP broadcast discovery packets with our HTTP port.
+    Reads packets straight into one preallocated buffer with recvfrom_into
+    instead of allocating per packet.
+    Needs a selector event loop (add_reader); raises NotImplementedError otherwise.
+    """
+    def __init__(self, sock, http_port, loop):
+        self.sock = sock
+        self.loop = loop
+        self.reply = _reply_for(http_port)
+        self.buf = bytearray(1024)
+        self.view = memoryview(self.buf)
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        try:
+            n, addr = self.sock.recvfrom_into(self.buf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            logger.error(f"UDP Error: {e}")
+            return
+
+        _handle_discovery(self.view, n, addr, self.reply, self.sock.sendto)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    """
+    Fallback for DiscoveryReceiver on loops without add_reader
+    (e.g. ProactorEventLoop on Windows).
+    """
+    def __init__(self, http_port):
+        self.reply = _reply_for(http_port)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        _handle_discovery(data, len(data), addr, self.reply, self.transport.sendto)
+
+    def error_received(self, exc):
+        logger.error(f"UDP Error: {exc}")
+
+async def start_udp_discovery(http_port):
+    """
+    Binds the discovery port and attaches a DiscoveryReceiver to it
+    (or a DiscoveryProtocol transport on loops without add_reader).
+    Returns the receiver/transport, or None if the port could not be bound.
     """
     UDP_PORT = 12345
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -25,108 +115,208 @@ async def udp_discovery_loop(http_port):
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
         sock.bind(('0.0.0.0', UDP_PORT))
-        sock.setblocking(False)
-        logger.info(f"UDP Discovery Server listening on port {UDP_PORT}")
     except Exception as e:
         logger.error(f"Failed to bind UDP port {UDP_PORT}: {e}")
-        return
-
-    loop = asyncio.get_event_loop()
+        sock.close()
+        return None
 
-    while True:
+    loop = asyncio.get_running_loop()
+    # Both keep the socket registered with the loop for their whole
+    # lifetime instead of re-adding a reader for every recvfrom
+    try:
         try:
-            data, addr = await loop.sock_recvfrom(sock, 1024)
-            message = data.decode('utf-8').strip()
-            
-            if message == "FLUENS_DISCOVER":
-                # Respond with our HTTP port
-                response = f"FLUENS_ESP32_HERE:{http_port}"
-                sock.sendto(response.encode('utf-8'), addr)
-                logger.info(f"Received discovery from {addr}, responded with {response}")
-                
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            logger.error(f"UDP Error: {e}")
-            await asyncio.sleep(1)
-    
-    sock.close()
+            transport = DiscoveryReceiver(sock, http_port, loop)
+        except NotImplementedError:
+            # e.g. ProactorEventLoop on Windows
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: DiscoveryProtocol(http_port), sock=sock)
+    except Exception as e:
+        logger.error(f"Failed to start UDP discovery: {e}")
+        sock.close()
+        return None
+    logger.info(f"UDP Discovery Server listening on port {UDP_PORT}")
+    return transport
+
+class MessageSlot:
+    """
+    Latest console message as a pre-encoded /messages body.
+    Polls read it without removing it; it stays until the app acknowledges it
+    with POST /response or a newer message replaces it. The app drops repeats
+    by id, so re-serving it is safe and a poll abandoned mid-wait loses nothing.
+    """
+    def __init__(self):
+        self.body = None
+        self.id = None
+        self.delivered_id = None
+        self.ready = asyncio.Event()
+
+    def put(self, msg_id, body):
+        self.id = msg_id
+        self.body = body
+        self.ready.set()
+
+    def ack(self):
+        # Don't drop a newer message typed while the app was generating
+        if self.id is not None and self.id == self.delivered_id:
+            self.id = None
+            self.body = None
+            self.ready.clear()
 
 async def handle_get_messages(request):
     """
     Handle poll request from app.
+    Holds the request open until a message is queued or the poll timeout expires.
     Returns:
        {"message": "The message", "id": "unique-id"} if a message exists.
        {} empty JSON if no message.
     """
-    global current_message
-    
-    data = {}
-    if current_message:
-        data = {
-            "message": current_message,
-            "id": current_message_id
-        }
-        # Only log once per message ID to avoid spam
-        # logger.info(f"App polled message: {current_message}")
-    
-    return web.Response(text=json.dumps(data), content_type='application/json')
+    msg_slot = request.app['msg_slot']
+    if msg_slot.body is None:
+        try:
+            await asyncio.wait_for(msg_slot.ready.wait(), timeout=request.app['poll_timeout'])
+        except asyncio.TimeoutError:
+            return web.Response(body=_EMPTY_BODY, content_type='application/json')
+
+    body = msg_slot.body
+    if body is None:
+        return web.Response(body=_EMPTY_BODY, content_type='application/json')
+    msg_slot.delivered_id = msg_slot.id
+    return web.Response(body=body, content_type='application/json')
 
 async def handle_post_response(request):
     """
     Handle AI response from app.
     Expects: {"response": "The AI response text"}
+    Acknowledges the delivered message so later polls wait for a new one.
     """
     try:
-        data = await request.json()
+        data = orjson.loads(await request.read())
         response_text = data.get('response', '')
         print(f"\n[APP SAYS]: {response_text}\n> ", end='', flush=True)
+        request.app['msg_slot'].ack()
         return web.Response(text="OK")
     except Exception as e:
         logger.error(f"Error handling response: {e}")
         return web.Response(status=400)
 
-async def console_input_loop():
-    """Simple blocking input loop running in executor"""
-    global current_message, current_message_id
+_last_message_id = 0
+
+def next_message_id():
+    """
+    Millisecond message id from the monotonic clock (immune to wall-clock steps).
+    Bumped by one if two messages land in the same millisecond, so ids never repeat.
+    """
+    global _last_message_id
+    _last_message_id = max(time.monotonic_ns() // 1_000_000, _last_message_id + 1)
+    return str(_last_message_id)
+
+def queue_message(msg_slot, msg):
+    """Encodes a console line and puts it in the message slot"""
+    msg = msg.strip()
+    if msg:
+        # Body is encoded once here rather than on every poll
+        msg_id = next_message_id()
+        body = orjson.dumps({
+            "message": msg,
+            "id": msg_id
+        })
+        # Single slot: a newer message replaces the current one
+        msg_slot.put(msg_id, body)
+        # print(f"[Queued]: '{msg}'")
+        print("> ", end='', flush=True)
+
+async def console_input_loop(msg_slot, discovery=True):
+    """
+    Reads console lines and queues them for the app.
+    stdin is watched by the event loop itself (add_reader), so no executor
+    thread is woken per line. Falls back to the executor where that isn't possible.
+    """
     print("\n---------------------------------------------------")
     print(" ESP32 MOCK SERVER")
     print("---------------------------------------------------")
-    print(" App will automatically discover this server.")
+    if discovery:
+        print(" App will automatically discover this server.")
+    else:
+        print(" Discovery is off: enter this server's URL in the app manually.")
     print(" Type a message below and press ENTER to send to the app.")
     print("---------------------------------------------------")
     print("> ", end='', flush=True)
-    
-    loop = asyncio.get_event_loop()
+
+    loop = asyncio.get_running_loop()
+    fd = sys.stdin.fileno()
+    eof = loop.create_future()
+    pending = bytearray()
+
+    def on_stdin_ready():
+        try:
+            chunk = os.read(fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            logger.error(f"Input error: {e}")
+            chunk = b''
+
+        if not chunk:
+            # EOF: flush a final line without a newline, like readline would
+            if pending:
+                queue_message(msg_slot, pending.decode('utf-8', errors='replace'))
+                pending.clear()
+            loop.remove_reader(fd)
+            if not eof.done():
+                eof.set_result(None)
+            return
+
+        pending.extend(chunk)
+        *lines, rest = pending.split(b'\n')
+        pending[:] = rest
+        for line in lines:
+            try:
+                queue_message(msg_slot, line.decode('utf-8', errors='replace'))
+            except Exception as e:
+                logger.error(f"Input error: {e}")
+
+    try:
+        loop.add_reader(fd, on_stdin_ready)
+    except (NotImplementedError, PermissionError, ValueError):
+        # Windows proactor loop, or stdin redirected from a regular file
+        await console_input_executor_loop(msg_slot)
+        return
+
+    try:
+        await eof
+    except asyncio.CancelledError:
+        loop.remove_reader(fd)
+
+async def console_input_executor_loop(msg_slot):
+    """Simple blocking input loop running in executor"""
+    loop = asyncio.get_running_loop()
     while True:
         try:
             # Run blocking input in a separate thread so it doesn't block the server
             msg = await loop.run_in_executor(None, sys.stdin.readline)
             if not msg:
                 break
-                
-            msg = msg.strip()
-            if msg:
-                current_message = msg
-                current_message_id = str(int(time.time() * 1000))
-                # print(f"[Queued]: '{msg}'")
-                print("> ", end='', flush=True)
-                
+
+            queue_message(msg_slot, msg)
+
         except asyncio.CancelledError:
             break
         except Exception as e:
             logger.error(f"Input error: {e}")
 
 async def start_background_tasks(app):
-    app['input_task'] = asyncio.create_task(console_input_loop())
-    app['udp_task'] = asyncio.create_task(udp_discovery_loop(app['http_port']))
+    app['msg_slot'] = MessageSlot()
+    app['input_task'] = asyncio.create_task(console_input_loop(app['msg_slot'], app['discovery']))
+    app['udp_transport'] = None
+    if app['discovery']:
+        app['udp_transport'] = await start_udp_discovery(app['http_port'])
 
 async def cleanup_background_tasks(app):
+    if app['udp_transport'] is not None:
+        app['udp_transport'].close()
     app['input_task'].cancel()
-    app['udp_task'].cancel()
     try:
         await app['input_task']
-        await app['udp_task']
     except asyncio.CancelledError:
         pass
 
@@ -134,10 +324,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="ESP32 Mock Server (Polling)")
     parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
     parser.add_argument("--host", default="0.0.0.0", help="Host interface")
+    parser.add_argument("--poll-timeout", type=float, default=LONG_POLL_TIMEOUT,
+                        help="Seconds GET /messages waits for a message before returning {}")
+    parser.add_argument("--discovery", action=argparse.BooleanOptionalAction, default=True,
+                        help="Answer UDP discovery broadcasts on port 12345")
     args = parser.parse_args()
 
     app = web.Application()
     app['http_port'] = args.port
+    app['poll_timeout'] = args.poll_timeout
+    app['discovery'] = args.discovery
     app.router.add_get('/messages', handle_get_messages)
     app.router.add_post('/response', handle_post_response)
     
@@ -145,5 +341,6 @@ if __name__ == "__main__":
     app.on_cleanup.append(cleanup_background_tasks)
 
     print(f"Starting Poll Server at http://{args.host}:{args.port}")
-    # Disable access logs to keep console clean for chat
-    web.run_app(app, host=args.host, port=args.port, access_log=None, print=None)
+    # Disable access logs to keep console clean for chat (and skip per-request log formatting)
+    loop = uvloop.new_event_loop() if uvloop is not None else None
+    web.run_app(app, host=args.host, port=args.port, access_log=None, print=None, loop=loop)